@@ -10,9 +10,13 @@ __version = "1.0.0"
 __date = "2024-03-11"
 
 # REQUIREMENTS
+# pip install numpy
 # pip install pandas
 # pip install openpyxl
-# pip install pyteomics
+# optional, for faster reading of .xlsx files:
+# pip install python-calamine
+# optional, for faster writing of .xlsx files:
+# pip install xlsxwriter
 
 #########################
 
@@ -32,6 +36,8 @@ scan_nr_repair_tool.py [-d --data]
                        [-c --colname]
                        [-p --pattern]
                        [-o --output]
+                       [-f --format]
+                       [--no-cache]
 required arguments:
     -d str, --data str
         Input data file to be fixed in .csv or .xlsx format.
@@ -47,6 +53,11 @@ optional arguments:
     -o str, --output str
         Name of the output file.
         Default: Name of the input data file + "_fixed.xlsx"
+    -f str, --format str
+        Format of the output file, one of "xlsx" or "csv".
+        Default: "xlsx"
+    --no-cache
+        Don't read or write the cached scan number mapping of the mgf file.
     -h, --help
         Show this help message and exit.
     --version
@@ -56,34 +67,114 @@ optional arguments:
 #########################
 
 # import packages
+import io
+import os
 import re
+import hashlib
 import argparse
+import numpy as np
 import pandas as pd
-from pyteomics import mgf
 
 import warnings
+import importlib.util
+from itertools import repeat
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 
 from typing import Any
 from typing import List
 from typing import Dict
 from typing import Tuple
 from typing import BinaryIO
+from typing import TextIO
+from typing import Iterator
+
+# read-ahead buffer size for mgf files, much larger than the 8 KiB default
+_MGF_BUFFER_SIZE = 1 << 20
+# mgf files smaller than this are parsed in a single process
+_PARALLEL_MIN_FILESIZE = 256 << 20
+# scan number mappings of previously read mgf files are cached here
+# bump when the parsing of scan numbers changes, so old cached mappings are not used
+_CACHE_VERSION = 1
+# empty or relative XDG_CACHE_HOME values are ignored as per the XDG spec
+_CACHE_HOME = os.environ.get("XDG_CACHE_HOME", "")
+if not os.path.isabs(_CACHE_HOME):
+    _CACHE_HOME = os.path.join(os.path.expanduser("~"), ".cache")
+_CACHE_DIR = os.path.join(_CACHE_HOME, "scan_nr_repair")
+
+# calamine is much faster than openpyxl for reading .xlsx files, if available
+_EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") is not None else "openpyxl"
+# same for xlsxwriter when writing .xlsx files
+_EXCEL_WRITER_ENGINE = "xlsxwriter" if importlib.util.find_spec("xlsxwriter") is not None else "openpyxl"
+
+# first bytes of mgf peak lines, checked for every line of the file
+_DIGIT_BYTES = frozenset(b"0123456789")
+
+# compiled once, used for stripping non-digits from title matches
+_NONDIGIT_RE = re.compile(r"[^0-9]")
+# faster str.translate table for the same, deletes all ascii non-digits
+_DIGITS_ONLY = [chr(c) if chr(c) in "0123456789" else None for c in range(128)]
+# matches scan tokens in titles like 'scan=123' or 'scan="123"'
+_SCAN_EQ_RE = re.compile(r"scan=[\"']?(\d+)")
 
 ####### FUNCTIONS #######
 
-# parse scan number from pyteomics mgf params
-def parse_scannr(params: Dict, pattern: str, i: int) -> Tuple[int, int]:
-    """Parses the scan number from the params dictionary of the pyteomics mgf
-    spectrum.
+# read title and scans params of every spectrum from a binary mgf file object
+def _fast_mgf_titles(fh: BinaryIO, end: int = -1) -> Iterator[Dict[str, str]]:
+    """Scans an mgf file line by line and yields a params dictionary for every
+    spectrum. Only the TITLE and SCANS lines are decoded, peak lines are
+    skipped without parsing. Leading whitespace is ignored like in pyteomics.
+
+    Parameters
+    ----------
+    fh : BinaryIO
+        The mgf file opened in binary mode (or any iterable of bytes lines if
+        end is negative).
+
+    end : int, default = -1
+        Byte offset at which to stop, spectra starting at or after this offset
+        are not read. If negative the file is read until the end.
+
+    Returns
+    -------
+    params : Iterator[Dict[str, str]]
+        The "params" dictionary of every spectrum, with keys "title" and
+        "scans" if present (same keys as in pyteomics).
+    """
+
+    params = dict()
+
+    for line in fh:
+        # peak lines start with a digit and are never needed
+        # lines read from a file are never empty, so line[0] is safe
+        if line[0] in _DIGIT_BYTES:
+            continue
+        stripped = line.lstrip()
+        if stripped.startswith(b"BEGIN IONS"):
+            if end >= 0 and fh.tell() - len(line) >= end:
+                return
+            params = dict()
+        elif stripped.startswith(b"TITLE="):
+            params["title"] = stripped[6:].decode("utf-8", errors = "replace").strip()
+        elif stripped.startswith(b"SCANS="):
+            params["scans"] = stripped[6:].decode("utf-8", errors = "replace").strip()
+        elif stripped.startswith(b"END IONS"):
+            yield params
+
+# parse scan number from mgf params
+def parse_scannr(params: Dict, pattern_re: re.Pattern, i: int) -> Tuple[int, int]:
+    """Parses the scan number from the params dictionary of an mgf spectrum.
 
     Parameters
     ----------
     params : Dict
-        The "params" dictionary of the pyteomics mgf spectrum.
+        The "params" dictionary of the mgf spectrum (as returned by pyteomics
+        or _fast_mgf_titles).
 
-    pattern : str
-        Regex pattern to use for parsing the scan number from the title if it
-        can't be infered otherwise.
+    pattern_re : re.Pattern
+        Compiled regex pattern to use for parsing the scan number from the title
+        if it can't be infered otherwise. If the pattern has a capturing group,
+        the scan number is taken from the first group.
 
     i : int
         The scan number to be returned in case of failure.
@@ -96,85 +187,346 @@ def parse_scannr(params: Dict, pattern: str, i: int) -> Tuple[int, int]:
     """
 
     # prefer scans attr over title attr
-    if "scans" in params:
-        try:
-            return (0, int(params["scans"]))
-        except:
-            pass
+    scans = params.get("scans")
+    if scans is not None:
+        if type(scans) is int:
+            return (0, scans)
+        if isinstance(scans, str):
+            # only copy the string if it isn't a clean number already
+            if not scans.isdecimal():
+                scans = scans.strip()
+            if scans.isdecimal():
+                return (0, int(scans))
 
     # try parse title
-    if "title" in params:
+    title = params.get("title")
+    if title is not None:
 
         # if there is a scan token in the title, try parse scan_nr
-        if "scan" in params["title"]:
-            try:
-                return (0, int(params["title"].split("scan=")[1].strip("\"")))
-            except:
-                pass
-
-        # else try to parse by patternq
-        try:
-            scan_nr = re.findall(pattern, params["title"])[0]
-            scan_nr = re.sub(r"[^0-9]", "", scan_nr)
-            if len(scan_nr) > 0:
-                return (0, int(scan_nr))
-        except:
-            pass
+        m = _SCAN_EQ_RE.search(title)
+        if m:
+            return (0, int(m.group(1)))
+
+        # else try to parse by pattern
+        # like re.findall, use the first group if the pattern has one
+        m = pattern_re.search(title)
+        scan_nr = ((m.group(1) if pattern_re.groups else m.group()) or "") if m else ""
+        scan_nr = scan_nr.translate(_DIGITS_ONLY)
+        # non-ascii characters are not covered by the translation table
+        if not scan_nr.isascii():
+            scan_nr = _NONDIGIT_RE.sub("", scan_nr)
+        if len(scan_nr) > 0:
+            return (0, int(scan_nr))
 
         # else try parse whole title
-        try:
-            return (0, int(params["title"]))
-        except:
-            pass
+        title = title.strip()
+        if title.isdecimal():
+            return (0, int(title))
 
     # return insuccessful parse
     return (1, i)
 
+# find byte offsets that split an mgf file into chunks of whole spectra
+def _mgf_chunk_offsets(filename: str, nr_chunks: int) -> List[int]:
+    """Splits an mgf file into (at most) nr_chunks byte ranges of roughly equal
+    size, each range starting at a "BEGIN IONS" line.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the mgf file.
+
+    nr_chunks : int
+        The number of chunks to split the file into.
+
+    Returns
+    -------
+    offsets : List[int]
+        Sorted byte offsets, chunk i spans from offsets[i] to offsets[i + 1].
+        The first offset is 0 and the last offset is the file size.
+    """
+
+    size = os.path.getsize(filename)
+    offsets = [0]
+
+    with open(filename, "rb") as fh:
+        for k in range(1, nr_chunks):
+            # seek one byte back so that a line starting exactly at the offset is kept
+            fh.seek(max(k * size // nr_chunks - 1, 0))
+            fh.readline()
+            pos = fh.tell()
+            line = fh.readline()
+            while line and not line.lstrip().startswith(b"BEGIN IONS"):
+                pos = fh.tell()
+                line = fh.readline()
+            if line and pos > offsets[-1]:
+                offsets.append(pos)
+
+    offsets.append(size)
+
+    return offsets
+
+# parse the scan numbers of all spectra in a byte range of an mgf file
+def _read_spectra_range(filename: str, start: int, end: int, pattern: str) -> Tuple[List[int], List[int]]:
+    """Parses the scan numbers of all spectra that start in the given byte range
+    of an mgf file. Used as the worker function of _read_spectra_parallel.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the mgf file.
+
+    start : int
+        Byte offset of the first "BEGIN IONS" line of the range.
+
+    end : int
+        Byte offset at which the range ends.
+
+    pattern : str
+        Regex pattern to use for parsing the scan number from the title if it
+        can't be infered otherwise.
+
+    Returns
+    -------
+    (scan_nrs, failed) : Tuple
+        A tuple with the scan numbers of all spectra in the range at the first
+        position [0] and the positions (within the range) of spectra whose scan
+        number could not be parsed at the second position [1].
+    """
+
+    pattern_re = re.compile(pattern)
+    scan_nrs = list()
+    failed = list()
+
+    with open(filename, "rb", buffering = _MGF_BUFFER_SIZE) as fh:
+        fh.seek(start)
+        for s, params in enumerate(_fast_mgf_titles(fh, end)):
+            scan_nr = parse_scannr(params, pattern_re, 0)
+            if scan_nr[0] != 0:
+                failed.append(s)
+            scan_nrs.append(scan_nr[1])
+
+    return (scan_nrs, failed)
+
+# read an mgf file in a single process and generate a scan number mapping
+def _read_spectra_sequential(filename: str | BinaryIO | TextIO, pattern: str) -> Tuple[np.ndarray, int]:
+    """Reads an mgf file in the current process.
+
+    Parameters
+    ----------
+    filename : str | BinaryIO | TextIO
+        Filename or file object (opened in binary or text mode) of the mgf file.
+
+    pattern : str
+        Regex pattern to use for parsing the scan number from the title if it
+        can't be infered otherwise.
+
+    Returns
+    -------
+    (mapping, exit_code) : Tuple
+        A tuple with the mapping of spectrum index to spectrum scan number (see
+        read_spectra) at the first position [0] and the number of spectra whose
+        scan number could not be parsed at the second position [1].
+    """
+
+    # position 0 is unused, see read_spectra
+    scan_nrs = [0]
+    exit_code = 0
+    pattern_re = re.compile(pattern)
+
+    buffered = None
+    if isinstance(filename, str):
+        mgf_file = open(filename, "rb", buffering = _MGF_BUFFER_SIZE)
+    elif isinstance(filename, io.RawIOBase):
+        # unbuffered file objects get a read-ahead buffer
+        buffered = io.BufferedReader(filename, buffer_size = _MGF_BUFFER_SIZE)
+        mgf_file = nullcontext(buffered)
+    elif isinstance(filename, io.TextIOBase):
+        # the line scanner works on bytes
+        mgf_file = nullcontext(line.encode("utf-8") for line in filename)
+    else:
+        mgf_file = nullcontext(filename)
+
+    try:
+        with mgf_file as fh:
+            for s, params in enumerate(_fast_mgf_titles(fh)):
+                scan_nr = parse_scannr(params, pattern_re, -(s + 1))
+                exit_code += scan_nr[0]
+                scan_nrs.append(scan_nr[1])
+    finally:
+        # detach so that closing the buffer doesn't close the caller's file object
+        if buffered is not None:
+            buffered.detach()
+
+    # converted once, so the array is allocated with its final size
+    return (np.array(scan_nrs, dtype = np.int64), exit_code)
+
+# read an mgf file in parallel and generate a scan number mapping
+def _read_spectra_parallel(filename: str, pattern: str, processes: int) -> Tuple[np.ndarray, int]:
+    """Reads an mgf file with multiple processes, each parsing a range of whole
+    spectra.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the mgf file.
+
+    pattern : str
+        Regex pattern to use for parsing the scan number from the title if it
+        can't be infered otherwise.
+
+    processes : int
+        The number of processes to use.
+
+    Returns
+    -------
+    (mapping, exit_code) : Tuple
+        A tuple with the mapping of spectrum index to spectrum scan number (see
+        read_spectra) at the first position [0] and the number of spectra whose
+        scan number could not be parsed at the second position [1].
+    """
+
+    offsets = _mgf_chunk_offsets(filename, processes)
+
+    # small files can yield fewer chunks than processes
+    with ProcessPoolExecutor(max_workers = len(offsets) - 1) as pool:
+        chunks = list(pool.map(_read_spectra_range, repeat(filename), offsets[:-1], offsets[1:], repeat(pattern)))
+
+    result = np.zeros(sum(len(chunk[0]) for chunk in chunks) + 1, dtype = np.int64)
+    exit_code = 0
+    i = 1
+
+    # chunks are in file order, failed spectra get their negative global index
+    for scan_nrs, failed in chunks:
+        result[i:i + len(scan_nrs)] = scan_nrs
+        for f in failed:
+            result[i + f] = -(i + f)
+        exit_code += len(failed)
+        i += len(scan_nrs)
+
+    return (result, exit_code)
+
+# generate the key for caching the scan number mapping of an mgf file
+def _mgf_cache_key(filename: str, pattern: str) -> str:
+    """Generates a cache key for the scan number mapping of an mgf file from the
+    first KiB of the file, its modification time, its size, the pattern and the
+    version of the tool.
+
+    Parameters
+    ----------
+    filename : str
+        Filename of the mgf file.
+
+    pattern : str
+        Regex pattern used for parsing the scan numbers.
+
+    Returns
+    -------
+    key : str
+        The cache key.
+    """
+
+    with open(filename, "rb") as fh:
+        sha1 = hashlib.sha1(fh.read(1024))
+    sha1.update(pattern.encode("utf-8"))
+    sha1.update(f"{__version}-{_CACHE_VERSION}".encode("utf-8"))
+
+    return f"{sha1.hexdigest()}-{os.path.getmtime(filename)}-{os.path.getsize(filename)}"
+
 # reading spectra and generate a scan number mapping
-def read_spectra(filename: str | BinaryIO, pattern: str = "\\.\\d+\\.") -> Dict[int, int]:
+def read_spectra(filename: str | BinaryIO | TextIO, pattern: str = "\\.\\d+\\.", processes: int | None = None, use_cache: bool = True) -> np.ndarray:
     """Reads an mgf file and maps the index of each spectrum in the file
     to its scan number.
 
     Parameters
     ----------
-    filename : str | BinaryIO
-        Filename or file object of the mgf file to be read by pyteomics.
+    filename : str | BinaryIO | TextIO
+        Filename or file object (opened in binary or text mode) of the mgf file.
 
     pattern : str, default = "\\.\\d+\\."
         Regex pattern to use for parsing the scan number from the title if it
         can't be infered otherwise.
 
+    processes : int | None, default = None
+        The number of processes to use for reading large mgf files (only used
+        if a filename is given). If None, all CPUs available to the process are
+        used.
+
+    use_cache : bool, default = True
+        If a filename is given, load the mapping from the cache directory if
+        the same file was read before, and store it there otherwise.
+
     Returns
     -------
-    mapping : Dict[int, int]
-        The mapping of spectrum index to spectrum scan number.
+    mapping : np.ndarray
+        The mapping of spectrum index to spectrum scan number as an int64 array
+        of length number of spectra + 1, so that mapping[i] is the scan number
+        of the i-th spectrum (starting at 1). Position 0 is unused.
 
     Examples
     --------
     >>> from scan_nr_repair_tool import read_spectra
     >>> mapping = read_spectra("data/example.mgf")
-    >>> mapping[0]
+    >>> mapping[1]
     2
     """
 
-    result_dict = dict()
-    exit_code = 0
+    if processes is None:
+        # respects cpu affinity and container limits where available
+        if hasattr(os, "sched_getaffinity"):
+            processes = len(os.sched_getaffinity(0))
+        else:
+            processes = os.cpu_count() or 1
 
-    with mgf.read(filename, use_index = True) as reader:
-        for s, spectrum in enumerate(reader):
-            scan_nr = parse_scannr(spectrum["params"], pattern, -(s + 1))
-            exit_code += scan_nr[0]
-            result_dict[s + 1] = scan_nr[1]
-        reader.close()
+    result = None
+    cache_file = None
 
-    print(f"\nFinished reading {s + 1} spectra!")
+    if use_cache and isinstance(filename, str):
+        cache_file = os.path.join(_CACHE_DIR, _mgf_cache_key(filename, pattern) + ".npy")
+        try:
+            result = np.load(cache_file)
+            # spectra that could not be parsed have negative scan numbers
+            exit_code = int(np.count_nonzero(result[1:] < 0))
+        except FileNotFoundError:
+            result = None
+        except Exception:
+            # corrupt or truncated cache file, remove it and read the mgf file again
+            result = None
+            try:
+                os.remove(cache_file)
+            except OSError:
+                pass
+
+    if result is None:
+        if isinstance(filename, str) and processes > 1 and os.path.getsize(filename) >= _PARALLEL_MIN_FILESIZE:
+            result, exit_code = _read_spectra_parallel(filename, pattern, processes)
+        else:
+            result, exit_code = _read_spectra_sequential(filename, pattern)
+
+        # caching is best effort, e.g. the cache directory might not be writable
+        if cache_file is not None:
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(_CACHE_DIR, exist_ok = True)
+                with open(tmp_file, "wb") as fh:
+                    np.save(fh, result)
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                try:
+                    os.remove(tmp_file)
+                except OSError:
+                    pass
+
+    nr_spectra = result.shape[0] - 1
+
+    print(f"\nFinished reading {nr_spectra} spectra!")
 
     if exit_code != 0:
         warnings.warn(f"Reading spectra exited with non-zero exit code. Scan numbers for {exit_code} spectra could not be parsed.", RuntimeWarning)
 
-    return result_dict
+    return result
 
-def repair_scan_numbers(filename_data: str, colname_scannr: str, filename_mgf: str, pattern: str = "\\.\\d+\\.") -> pd.DataFrame:
+def repair_scan_numbers(filename_data: str, colname_scannr: str, filename_mgf: str, pattern: str = "\\.\\d+\\.", use_cache: bool = True) -> pd.DataFrame:
     """Repairs the scan numbers of the given input file.
 
     Parameters
@@ -193,6 +545,10 @@ def repair_scan_numbers(filename_data: str, colname_scannr: str, filename_mgf: s
         Regex pattern to use for parsing the scan number from the title if it
         can't be infered otherwise.
 
+    use_cache : bool, default = True
+        Whether to use the cached scan number mapping of the mgf file, see
+        read_spectra.
+
     Returns
     -------
     fixed_data : pd.DataFrame
@@ -223,13 +579,20 @@ def repair_scan_numbers(filename_data: str, colname_scannr: str, filename_mgf: s
     if ext == "csv":
         df = pd.read_csv(filename_data)
     elif ext == "xlsx":
-        df = pd.read_excel(filename_data)
+        df = pd.read_excel(filename_data, engine = _EXCEL_ENGINE)
     else:
         raise ValueError(f"Unsupported file extension {ext} - please use a .csv or .xlsx file as input!")
 
-    mapping = read_spectra(filename_mgf, pattern)
+    mapping = read_spectra(filename_mgf, pattern, use_cache = use_cache)
+
+    scannrs = df[colname_scannr].to_numpy(dtype = np.int64)
+
+    invalid = (scannrs < 1) | (scannrs >= mapping.shape[0])
+    if invalid.any():
+        missing = np.unique(scannrs[invalid]).tolist()
+        raise KeyError(f"Scan numbers {missing} not found in the mgf file!")
 
-    df[colname_scannr] = df[colname_scannr].apply(lambda x: mapping[int(x)])
+    df[colname_scannr] = mapping[scannrs]
 
     return df
 
@@ -296,15 +659,29 @@ def main(argv = None) -> pd.DataFrame:
                         default = None,
                         help = "Name of the output file.",
                         type = str)
+    parser.add_argument("-f", "--format",
+                        dest = "format",
+                        default = "xlsx",
+                        choices = ["xlsx", "csv"],
+                        help = "Format of the output file.",
+                        type = str)
+    parser.add_argument("--no-cache",
+                        dest = "no_cache",
+                        action = "store_true",
+                        help = "Don't read or write the cached scan number mapping of the mgf file.")
     args = parser.parse_args(argv)
 
     if args.output is None:
-        output = args.df + "_fixed.xlsx"
+        output = args.df + "_fixed." + args.format
     else:
-        output = args.output + ".xlsx"
+        output = args.output + "." + args.format
+
+    fixed = repair_scan_numbers(args.df, args.colname, args.mgf, args.pattern, not args.no_cache)
 
-    fixed = repair_scan_numbers(args.df, args.colname, args.mgf, args.pattern)
-    fixed.to_excel(output)
+    if args.format == "csv":
+        fixed.to_csv(output, index = False)
+    else:
+        fixed.to_excel(output, engine = _EXCEL_WRITER_ENGINE, index = False)
 
     return fixed
 
@@ -5,9 +5,186 @@
 # https://github.com/michabirklbauer/
 # micha.birklbauer@gmail.com
 
+import pytest
+
+# never read or write the real mapping cache in tests
+@pytest.fixture(autouse = True)
+def isolated_cache(tmp_path, monkeypatch):
+
+    import scan_nr_repair_tool
+
+    monkeypatch.setattr(scan_nr_repair_tool, "_CACHE_DIR", str(tmp_path / "scan_nr_repair"))
+
 def test1():
 
     from scan_nr_repair_tool import main
 
     assert main(["-d", "example_proteome_discoverer_output.xlsx",
                  "-m", "example.mgf"])["First Scan"][0] == 144
+
+def test2():
+
+    import re
+    from scan_nr_repair_tool import parse_scannr
+
+    pattern_re = re.compile("sample1\\.(\\d+)\\.")
+
+    assert parse_scannr({"title": "sample1.45.45.2"}, pattern_re, -1) == (0, 45)
+    assert parse_scannr({"title": "B190125_rep1.2.2.3"}, re.compile("\\.\\d+\\."), -1) == (0, 2)
+
+def test3():
+
+    import io
+    from scan_nr_repair_tool import _fast_mgf_titles
+
+    mgf = (b"MASS=Monoisotopic\r\n"
+           b"BEGIN IONS\r\n"
+           b"TITLE=run.1.1.2\r\n"
+           b"SCANS=11\r\n"
+           b"100.1 20.0\r\n"
+           b"END IONS\r\n"
+           b"\r\n"
+           b"# comment\r\n"
+           b"BEGIN IONS\r\n"
+           b"  TITLE=run.7.7.2\r\n"
+           b"  SCANS=7\r\n"
+           b"END IONS")
+
+    assert list(_fast_mgf_titles(io.BytesIO(mgf))) == [{"title": "run.1.1.2", "scans": "11"},
+                                                       {"title": "run.7.7.2", "scans": "7"}]
+
+def test4():
+
+    import io
+    import re
+    from scan_nr_repair_tool import parse_scannr
+    from scan_nr_repair_tool import read_spectra
+
+    pattern_re = re.compile("\\.\\d+\\.")
+
+    # scans is preferred over title, title is used if scans can't be parsed
+    assert parse_scannr({"title": "run.1.1.2", "scans": "11"}, pattern_re, -1) == (0, 11)
+    assert parse_scannr({"title": "run.1.1.2", "scans": "x"}, pattern_re, -1) == (0, 1)
+    assert parse_scannr({"title": "run scan=\"5\"", "scans": "x"}, pattern_re, -1) == (0, 5)
+    assert parse_scannr({"title": "run"}, pattern_re, -1) == (1, -1)
+
+    mgf = "BEGIN IONS\nTITLE=run.3.3.2\n100.1 20.0\nEND IONS\n"
+
+    assert read_spectra(io.StringIO(mgf)).tolist() == [0, 3]
+    assert read_spectra(io.BytesIO(mgf.encode("utf-8"))).tolist() == [0, 3]
+
+def test5():
+
+    import io
+    from scan_nr_repair_tool import read_spectra
+
+    class FailingRaw(io.RawIOBase):
+        def readable(self):
+            return True
+        def readinto(self, b):
+            raise OSError("read failed")
+
+    raw = FailingRaw()
+
+    try:
+        read_spectra(raw)
+    except OSError:
+        pass
+
+    import gc
+    gc.collect()
+
+    assert not raw.closed
+
+def test6(tmp_path, monkeypatch):
+
+    import pytest
+    import numpy as np
+    import scan_nr_repair_tool
+    from scan_nr_repair_tool import read_spectra
+    from scan_nr_repair_tool import _mgf_chunk_offsets
+    from scan_nr_repair_tool import _read_spectra_sequential
+
+    # spectra 150 and 200 have unparseable titles and end up in later chunks
+    filename = str(tmp_path / "parallel.mgf")
+    with open(filename, "w") as f:
+        f.write("MASS=Monoisotopic\n")
+        for i in range(1, 201):
+            title = "garbage" if i in (150, 200) else f"run.{2 * i}.{2 * i}.2"
+            f.write(f"BEGIN IONS\nTITLE={title}\nPEPMASS=500.0\n")
+            f.write("".join(f"{100 + p}.5 {p}.0\n" for p in range(i % 7)))
+            f.write("END IONS\n")
+
+    monkeypatch.setattr(scan_nr_repair_tool, "_PARALLEL_MIN_FILESIZE", 0)
+
+    # record pool sizes, there should never be more workers than chunks
+    pool_sizes = list()
+    ProcessPoolExecutor = scan_nr_repair_tool.ProcessPoolExecutor
+    def recording_pool(max_workers):
+        pool_sizes.append(max_workers)
+        return ProcessPoolExecutor(max_workers = max_workers)
+    monkeypatch.setattr(scan_nr_repair_tool, "ProcessPoolExecutor", recording_pool)
+
+    sequential, exit_code = _read_spectra_sequential(filename, "\\.\\d+\\.")
+
+    assert exit_code == 2
+    assert sequential[150] == -150 and sequential[200] == -200
+
+    # the file has to be split for the parallel path to be tested
+    assert len(_mgf_chunk_offsets(filename, 7)) == 8
+
+    for processes in [2, 3, 7, 16, 64]:
+        with pytest.warns(RuntimeWarning):
+            parallel = read_spectra(filename, processes = processes, use_cache = False)
+        assert np.array_equal(parallel, sequential)
+        assert pool_sizes[-1] == len(_mgf_chunk_offsets(filename, processes)) - 1
+
+def test7(tmp_path, monkeypatch):
+
+    import os
+    import scan_nr_repair_tool
+    from scan_nr_repair_tool import read_spectra
+    from scan_nr_repair_tool import _mgf_cache_key
+
+    monkeypatch.setattr(scan_nr_repair_tool, "_CACHE_DIR", str(tmp_path / "cache"))
+
+    filename = str(tmp_path / "cache.mgf")
+    with open(filename, "w") as f:
+        f.write("BEGIN IONS\nTITLE=run.3.3.2\n100.1 20.0\nEND IONS\n")
+
+    cache_file = os.path.join(str(tmp_path / "cache"), _mgf_cache_key(filename, "\\.\\d+\\.") + ".npy")
+
+    assert read_spectra(filename, use_cache = False).tolist() == [0, 3]
+    assert not os.path.exists(cache_file)
+
+    assert read_spectra(filename).tolist() == [0, 3]
+    assert os.path.exists(cache_file)
+    assert read_spectra(filename).tolist() == [0, 3]
+
+    # a truncated cache file is replaced
+    open(cache_file, "wb").close()
+    assert read_spectra(filename).tolist() == [0, 3]
+    assert os.path.getsize(cache_file) > 0
+
+    # the tool version is part of the key
+    monkeypatch.setattr(scan_nr_repair_tool, "_CACHE_VERSION", -1)
+    assert _mgf_cache_key(filename, "\\.\\d+\\.") + ".npy" != os.path.basename(cache_file)
+
+def test8(tmp_path):
+
+    import pandas as pd
+    from scan_nr_repair_tool import repair_scan_numbers
+
+    # scan numbers already equal spectrum indices
+    filename_mgf = str(tmp_path / "identity.mgf")
+    with open(filename_mgf, "w") as f:
+        for i in range(1, 4):
+            f.write(f"BEGIN IONS\nTITLE=run.{i}.{i}.2\nEND IONS\n")
+
+    filename_data = str(tmp_path / "data.csv")
+    pd.DataFrame({"First Scan": [1.0, 3.0]}).to_csv(filename_data, index = False)
+
+    df = repair_scan_numbers(filename_data, "First Scan", filename_mgf, use_cache = False)
+
+    assert df["First Scan"].dtype == "int64"
+    assert df["First Scan"].tolist() == [1, 3]